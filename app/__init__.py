@@ -1,11 +1,13 @@
 import os
 from flask import Flask
-from app.config import load_configurations, configure_logging
+from app.config import load_configurations, configure_logging, OrjsonProvider
 from .views import webhook_blueprint
 
 
 def create_app():
-    app = Flask(__name__)
+    # Templates live at the repository root, next to run.py
+    app = Flask(__name__, template_folder="../templates")
+    app.json = OrjsonProvider(app)
 
     # Load configurations and logging settings
     load_configurations(app)
@@ -1,7 +1,9 @@
 import sys
 import os
 from dotenv import load_dotenv
+from flask.json.provider import DefaultJSONProvider
 import logging
+import orjson
 
 
 def load_configurations(app):
@@ -11,9 +13,16 @@ def load_configurations(app):
     app.config["APP_ID"] = os.getenv("APP_ID")
     app.config["APP_SECRET"] = os.getenv("APP_SECRET")
     app.config["RECIPIENT_WAID"] = os.getenv("RECIPIENT_WAID")
-    app.config["VERSION"] = os.getenv("VERSION")
+    app.config["VERSION"] = os.getenv("VERSION", "v22.0")
     app.config["PHONE_NUMBER_ID"] = os.getenv("PHONE_NUMBER_ID")
     app.config["VERIFY_TOKEN"] = os.getenv("VERIFY_TOKEN")
+    app.config["ADMIN_NUMBER"] = os.getenv("ADMIN_NUMBER")  # Admin's WhatsApp number
+    app.config["VERIFY_CODE_TOKEN"] = os.getenv("VERIFY_CODE_TOKEN")  # Shared secret for /verify_code
+    app.config["PIN_HMAC_KEY"] = os.getenv("PIN_HMAC_KEY")  # Keys pending-PIN digests
+    if not app.config["PIN_HMAC_KEY"]:
+        # An unkeyed digest of a 4-digit PIN can be brute-forced offline
+        logging.error("PIN_HMAC_KEY is not set")
+        raise RuntimeError("PIN_HMAC_KEY must be set")
 
 
 def configure_logging():
@@ -22,3 +31,25 @@ def configure_logging():
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
         stream=sys.stdout,
     )
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider that encodes and decodes with orjson.
+
+    The sort_keys and indent options Flask passes are honoured (orjson always
+    indents by two spaces). Dates and datetimes go through Flask's default
+    hook, so they keep its HTTP-date format. ensure_ascii is not supported:
+    output is always UTF-8.
+    """
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=kwargs.get("default", self.default), option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
@@ -36,3 +36,21 @@ def signature_required(f):
         return f(*args, **kwargs)
 
     return decorated_function
+
+
+def verify_token_required(f):
+    """
+    Decorator to ensure that requests to the gate verification endpoint carry the shared VERIFY_CODE_TOKEN.
+    """
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        expected_token = current_app.config.get("VERIFY_CODE_TOKEN") or ""
+        token = request.headers.get("X-Verify-Token", "")
+        # Fail closed: with no token configured, nothing is accepted
+        if not expected_token or not hmac.compare_digest(expected_token, token):
+            logging.info("Verify token check failed!")
+            return jsonify({"valid": False, "message": "Invalid token"}), 403
+        return f(*args, **kwargs)
+
+    return decorated_function
@@ -1,33 +1,81 @@
 import logging
-import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
-import qrcode
-from io import BytesIO
 import os
+import atexit
 import bcrypt
-from datetime import datetime, timedelta, timezone
-import base64
-import random
+from datetime import date, datetime, timedelta, timezone
+from collections import OrderedDict
+import copy
+import hashlib
+import hmac
+import secrets
 import string
+import threading
 import traceback
-from flask import Flask, request, jsonify, render_template, current_app
+from cachetools import TTLCache
+from flask import current_app, jsonify
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.api_core.exceptions import AlreadyExists
 from google.cloud.firestore_v1 import DocumentSnapshot
 from google.protobuf.timestamp_pb2 import Timestamp
 
 
-app = Flask(__name__)
-app.config["ACCESS_TOKEN"] = os.getenv("ACCESS_TOKEN")
-app.config["VERSION"] = "v22.0"
-app.config["PHONE_NUMBER_ID"] = os.getenv("PHONE_NUMBER_ID")
-app.config["ADMIN_NUMBER"] = os.getenv("ADMIN_NUMBER")  # Admin's WhatsApp number
+# Graph API endpoint and auth headers, built from the app config on first use
+graph_api_context = None
+
+
+def get_graph_api_context():
+    """
+    Return the (url, headers) pair for the Graph API messages endpoint.
+
+    The values never change at runtime, so they are read from the app config
+    once and reused for every outbound call.
+    """
+    global graph_api_context
+    if graph_api_context is None:
+        config = current_app.config
+        url = f"https://graph.facebook.com/{config['VERSION']}/{config['PHONE_NUMBER_ID']}/messages"
+        headers = {
+            "Content-type": "application/json",
+            "Authorization": f"Bearer {config['ACCESS_TOKEN']}",
+        }
+        graph_api_context = (url, headers)
+    return graph_api_context
+
+# (connect, read) timeout for every Graph API call
+GRAPH_API_TIMEOUT = (3.05, 10)
+
+# Shared HTTP session so Graph API calls reuse pooled keep-alive connections.
+# Sends are not idempotent, so only connection failures (request never left)
+# are retried. Read timeouts and error statuses reach send_message as
+# requests.Timeout / HTTPError with the response attached.
+http_session = requests.Session()
+http_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=20,
+        pool_maxsize=100,
+        max_retries=Retry(
+            total=3,
+            connect=3,
+            read=False,
+            status=0,
+            respect_retry_after_header=False,
+            backoff_factor=0.2,
+            allowed_methods=["POST"],
+        ),
+    ),
+)
 
 # Initialize Firestore (add this near the top of your file)
 def initialize_firestore():
     try:
-        cred_dict = json.loads(os.environ['FIREBASE_CREDENTIALS'])
+        cred_dict = orjson.loads(os.environ['FIREBASE_CREDENTIALS'])
         cred = credentials.Certificate(cred_dict)
         firebase_admin.initialize_app(cred)
         return firestore.client()
@@ -42,93 +90,208 @@ SESSIONS_COLLECTION = "whatsapp_sessions"
 RESIDENTS_COLLECTION = "residents"
 CODES_COLLECTION = "active_codes"
 
+# Patterns used on every inbound message
+BRACKETS_RE = re.compile(r"【.*?】")
+BOLD_RE = re.compile(r"\*\*(.*?)\*\*")
+ISO_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+# Characters used for visitor access codes
+CODE_ALPHABET = string.ascii_uppercase + string.digits
+
+# Sessions recently read or written by this process. render.yaml pins gunicorn
+# to a single worker, so a cached session only changes through the helpers
+# below. Callers always get their own copy to mutate.
+SESSION_CACHE_TTL = 60
+session_cache = TTLCache(maxsize=10000, ttl=SESSION_CACHE_TTL)
+session_cache_lock = threading.Lock()
+
+
+def merge_session_fields(target, fields):
+    """Apply fields to target the way a Firestore set(merge=True) does"""
+    for key, value in fields.items():
+        if value is firestore.DELETE_FIELD:
+            target.pop(key, None)
+        elif value and isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_session_fields(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+def cache_session_update(wa_id, session_data):
+    """Write a merged session update through to the cached copy, if any"""
+    with session_cache_lock:
+        cached = session_cache.get(wa_id)
+        if cached is not None:
+            merge_session_fields(cached, session_data)
+            session_cache[wa_id] = cached
+
+
+def get_cached_session(wa_id):
+    """Return a copy of the cached session, or None on a cache miss"""
+    with session_cache_lock:
+        cached = session_cache.get(wa_id)
+    return copy.deepcopy(cached) if cached is not None else None
+
+
+def cache_session(wa_id, session):
+    with session_cache_lock:
+        session_cache[wa_id] = copy.deepcopy(session)
+
+
 # Helper functions for Firestore operations
-def get_session(wa_id):
-    doc_ref = db.collection(SESSIONS_COLLECTION).document(wa_id)
-    doc = doc_ref.get()
-    return doc.to_dict() if doc.exists else None
+# Sessions are keyed by wa_id, and so are residents written by update_resident
+def get_session_and_resident(wa_id):
+    """
+    Fetch the session and resident documents in one batched read.
+    Returns (session, resident), each None if missing; a session is cached.
+    """
+    session_ref = db.collection(SESSIONS_COLLECTION).document(wa_id)
+    resident_ref = db.collection(RESIDENTS_COLLECTION).document(wa_id)
+    docs = {doc.reference.path: doc for doc in db.get_all([session_ref, resident_ref])}
+    session_doc, resident_doc = docs[session_ref.path], docs[resident_ref.path]
+
+    session = session_doc.to_dict() if session_doc.exists else None
+    if session is not None:
+        cache_session(wa_id, session)
+    if resident_doc.exists:
+        resident = resident_doc.to_dict()
+    else:
+        resident = find_resident_by_wa_id(wa_id)
+    return session, resident
 
 def update_session(wa_id, session_data):
     db.collection(SESSIONS_COLLECTION).document(wa_id).set(session_data, merge=True)
+    cache_session_update(wa_id, session_data)
 
 def delete_session(wa_id):
     db.collection(SESSIONS_COLLECTION).document(wa_id).delete()
+    with session_cache_lock:
+        session_cache.pop(wa_id, None)
 
 def get_resident(wa_id):
     doc_ref = db.collection(RESIDENTS_COLLECTION).document(wa_id)
     doc = doc_ref.get()
-    return doc.to_dict() if doc.exists else None
+    return doc.to_dict() if doc.exists else find_resident_by_wa_id(wa_id)
+
+def find_resident_by_wa_id(wa_id):
+    """
+    Fallback for resident documents stored under some other id (e.g. added
+    by hand) that only carry wa_id as a field.
+    """
+    query = db.collection(RESIDENTS_COLLECTION).where("wa_id", "==", wa_id).limit(1)
+    for doc in query.stream():
+        return doc.to_dict()
+    return None
 
 def update_resident(wa_id, resident_data):
     db.collection(RESIDENTS_COLLECTION).document(wa_id).set(resident_data)
 
-def get_code(code):
-    doc_ref = db.collection(CODES_COLLECTION).document(code)
-    doc = doc_ref.get()
-    return doc.to_dict() if doc.exists else None
 
-def update_code(code, code_data):
-    db.collection(CODES_COLLECTION).document(code).set(code_data)
+# Cost 10 is ~4x cheaper to check than bcrypt's default of 12; existing
+# hashes keep their own cost, so checkpw accepts both
+BCRYPT_ROUNDS = 10
 
-def delete_code(code):
-    db.collection(CODES_COLLECTION).document(code).delete()
+# A 4-digit PIN has only 10000 values, so wrong guesses are capped per wa_id
+# instead of relying on bcrypt cost to slow them down
+PIN_MAX_ATTEMPTS = 5
+PIN_LOCKOUT = timedelta(minutes=15)
 
-def get_expired_codes():
-    now = datetime.now()
-    expired_codes = db.collection(CODES_COLLECTION) \
-        .where("expiry", "<=", now) \
-        .stream()
-    return [code.id for code in expired_codes]
+def hash_pin(pin):
+    return bcrypt.hashpw(pin.encode("utf-8"), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode("utf-8")
 
 
-def hash_pin(pin):
-    return bcrypt.hashpw(pin.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+def format_timestamp(dt):
+    """Format a datetime as 'YYYY-MM-DD HH:MM:SS' (timezone is not shown)"""
+    return dt.replace(tzinfo=None, microsecond=0).isoformat(sep=" ")
+
+
+def format_minute(dt):
+    """Format a datetime as 'YYYY-MM-DD HH:MM' (timezone is not shown)"""
+    return dt.replace(tzinfo=None).isoformat(sep=" ", timespec="minutes")
+
+
+def digest_pin(pin):
+    """Cheap keyed digest used only to check the PIN was typed the same way twice"""
+    key = current_app.config["PIN_HMAC_KEY"].encode("utf-8")
+    return hmac.new(key, pin.encode("utf-8"), hashlib.blake2s).hexdigest()
 
 
 def notify_admin(message):
     """Send notification to admin WhatsApp number"""
-    if not app.config["ADMIN_NUMBER"]:
+    admin_number = current_app.config["ADMIN_NUMBER"]
+    if not admin_number:
         logging.warning("No ADMIN_NUMBER configured, skipping admin notification")
         return
-    
-    headers = {
-        "Content-type": "application/json",
-        "Authorization": f"Bearer {app.config['ACCESS_TOKEN']}",
-    }
 
-    url = f"https://graph.facebook.com/{app.config['VERSION']}/{app.config['PHONE_NUMBER_ID']}/messages"
-    
-    data = {
-        "messaging_product": "whatsapp",
-        "to": app.config["ADMIN_NUMBER"],
-        "type": "text",
-        "text": {"body": message}
-    }
+    send_message(get_text_message_input(admin_number, message))
+
+# Admin alerts are buffered and sent as one WhatsApp message per flush window
+ADMIN_FLUSH_SECONDS = 15
+ADMIN_FLUSH_MAX_EVENTS = 20
+admin_outbox = []
+admin_outbox_lock = threading.Lock()
+admin_flush_timer = None
+admin_flush_app = None  # app the exit-time flush sends through
 
-    try:
-        response = requests.post(url, headers=headers, json=data)
-        logging.info(f"Admin notification sent: {response.status_code}")
-    except Exception as e:
-        logging.error(f"Failed to send admin notification: {e}")
 
-@app.route('/webhook', methods=["POST"])
-def webhook():
-    body = request.json
-    if is_valid_whatsapp_message(body):
-        process_whatsapp_message(body)
-    return "ok", 200
+def queue_admin_notification(message):
+    """
+    Buffer an admin alert instead of sending it right away.
+
+    Buffered alerts go out together ADMIN_FLUSH_SECONDS after the first one,
+    or as soon as ADMIN_FLUSH_MAX_EVENTS have piled up.
+    """
+    global admin_flush_timer, admin_flush_app
+    app = current_app._get_current_object()
+
+    with admin_outbox_lock:
+        admin_flush_app = app
+        admin_outbox.append(message)
+        full = len(admin_outbox) >= ADMIN_FLUSH_MAX_EVENTS
+        if full and admin_flush_timer is not None:
+            admin_flush_timer.cancel()
+            admin_flush_timer = None
+        if admin_flush_timer is None:
+            delay = 0 if full else ADMIN_FLUSH_SECONDS
+            admin_flush_timer = threading.Timer(delay, flush_admin_notifications, args=(app,))
+            admin_flush_timer.daemon = True
+            admin_flush_timer.start()
+
+
+def flush_admin_notifications(app):
+    """Send every buffered admin alert as a single message"""
+    global admin_flush_timer
+    with admin_outbox_lock:
+        messages = admin_outbox[:]
+        admin_outbox.clear()
+        admin_flush_timer = None
+
+    if messages:
+        with app.app_context():
+            notify_admin("\n---\n".join(messages))
+
+
+@atexit.register
+def flush_admin_notifications_at_exit():
+    """Send alerts still buffered when the process stops (restart or redeploy)"""
+    with admin_outbox_lock:
+        timer = admin_flush_timer
+    if timer is not None:
+        timer.cancel()
+    if admin_flush_app is not None:
+        flush_admin_notifications(admin_flush_app)
 
-@app.route('/verify')
-def verify_qr():
-    return render_template("verify.html")
 
 def log_http_response(response):
-    logging.info(f"Status: {response.status_code}")
-    logging.info(f"Content-type: {response.headers.get('content-type')}")
-    logging.info(f"Body: {response.text}")
+    # %-style arguments are only formatted if INFO is enabled
+    logging.info("Status: %s", response.status_code)
+    logging.info("Content-type: %s", response.headers.get("content-type"))
+    # Only decode the body when something went wrong
+    if response.status_code >= 400:
+        logging.info("Body: %s", response.text)
 
 def get_text_message_input(recipient, text):
-    return json.dumps({
+    return orjson.dumps({
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
         "to": recipient,
@@ -136,87 +299,16 @@ def get_text_message_input(recipient, text):
         "text": {"preview_url": False, "body": text},
     })
 
-def get_resident(wa_id):
-    """
-    Fetch resident data from Firestore using WhatsApp ID (wa_id)
-    Returns:
-        - Resident data as dict if found
-        - None if not found
-    """
-    try:
-        # Query residents collection where wa_id matches
-        residents_ref = db.collection("residents")
-        query = residents_ref.where("wa_id", "==", wa_id).limit(1)
-        docs = query.stream()
-        
-        # Extract the first matching document
-        for doc in docs:
-            resident_data = doc.to_dict()
-            return resident_data
-        
-        return None  # No resident found
-    
-    except Exception as e:
-        print(f"Error fetching resident data: {e}")
-        return None
+# Fresh codes to try before giving up on a booking
+CODE_ATTEMPTS = 3
 
 def generate_random_code(length=6):
     """Generate a random alphanumeric code of specified length"""
-    characters = string.ascii_uppercase + string.digits
-    return ''.join(random.choice(characters) for _ in range(length))
-
-@app.route('/verify_code', methods=["POST"])
-def verify_code():
-    """Endpoint for security to verify codes"""
-    data = request.json
-    code = data.get("code", "").strip().upper()
-    
-    if not code:
-        return jsonify({"valid": False, "message": "No code provided"}), 400
-    
-    code_data = get_code(code)
-    if not code_data:
-        notify_admin(f"❌ Invalid code attempt: {code}")
-        return jsonify({"valid": False, "message": "Invalid code"}), 404
-    
-    now = datetime.now()
-    
-    if code_data["used"]:
-        notify_admin(f"⚠️ Already used code: {code}\nVisitor: {code_data['name']}\nDate: {code_data['date']}")
-        return jsonify({"valid": False, "message": "Code already used"}), 403
-    
-    if now > code_data["expiry"]:
-        notify_admin(f"⌛ Expired code: {code}\nVisitor: {code_data['name']}\nDate: {code_data['date']}")
-        return jsonify({"valid": False, "message": "Code expired"}), 403
-    
-    # Mark code as used and record verification time
-    code_data["used"] = True
-    code_data["verified_at"] = now.strftime("%Y-%m-%d %H:%M:%S")
-    update_code(code, code_data)
-    
-    # Notify admin of successful verification
-    notify_admin(
-        f"✅ Access granted\n"
-        f"Code: {code}\n"
-        f"Visitor: {code_data['name']}\n"
-        f"Date: {code_data['date']}\n"
-        f"Verified at: {now.strftime('%Y-%m-%d %H:%M:%S')}"
-    )
-    
-    return jsonify({
-        "valid": True,
-        "message": "Access granted",
-        "visitor": {
-            "name": code_data["name"],
-            "date": code_data["date"],
-            "code": code,
-            "expiry": code_data["expiry"].strftime("%Y-%m-%d %H:%M")
-        }
-    })
+    return ''.join(secrets.choice(CODE_ALPHABET) for _ in range(length))
 
 def validate_pin(pin):
     """Validate PIN with additional checks"""
-    if not (pin.isdigit() and len(pin) == 4):
+    if not (len(pin) == 4 and pin.isdigit()):
         return False
     
     # Optional: Prevent simple PINs like '0000' or '1234'
@@ -227,16 +319,242 @@ def validate_pin(pin):
     
     return True
 
-def generate_response(message_body, wa_id=None, name=None):
-    # Clean up expired codes first
-    expired_codes = get_expired_codes()
-    for code in expired_codes:
-        delete_code(code)
+DATE_MENU = (
+    "1. Today\n"
+    "2. Tomorrow\n"
+    "3. Specify date (YYYY-MM-DD)"
+)
+
+# Menu replies for the visit date, as day offsets from today
+DATE_ALIASES = {"1": 0, "today": 0, "2": 1, "tomorrow": 1}
+
+
+# Conversation step handlers. Each takes (user_session, message_body, wa_id),
+# persists any session change and returns the reply text.
+def handle_expect_greeting(user_session, message_body, wa_id):
+    if message_body.lower() in ["hi", "hello", "hey", "hola"]:
+        user_session["step"] = "ask_visitor_name"
+        update_session(wa_id, user_session)
+        return "Great! Please enter visitor name:"
+    return "Please say hello to continue with your booking."
+
+
+def handle_set_pin(user_session, message_body, wa_id):
+    if validate_pin(message_body):
+        user_session["pin"] = digest_pin(message_body)  # never keep the PIN itself
+        user_session["step"] = "confirm_pin"
+        update_session(wa_id, user_session)
+        return "Please confirm your 4-digit PIN:"
+    return "Invalid PIN. Please enter a more secure PIN exactly 4 digits."
+
+
+def handle_confirm_pin(user_session, message_body, wa_id):
+    if not hmac.compare_digest(digest_pin(message_body), user_session.get("pin", "")):
+        return "PINs don't match. Please enter a new 4-digit PIN:"
+
+    if user_session.get("is_new_user"):
+        user_session["step"] = "ask_resident_name"
+        user_session["resident_info"] = {"pin": hash_pin(message_body)}  # Hash the PIN before storing
+        user_session["pin"] = firestore.DELETE_FIELD
+        update_session(wa_id, user_session)
+        return "PIN set successfully!\nPlease enter your name (resident):"
+
+    # For returning users, use resident info from database
+    resident = get_resident(wa_id)
+    if resident:
+        user_session["resident_info"] = {
+            "resident_name": resident.get("resident_name"),
+            "house_number": resident.get("house_number"),
+            "street_name": resident.get("street_name"),
+            "pin": resident.get("pin")  # Already hashed in DB
+        }
+    user_session["step"] = "ask_visitor_name"
+    update_session(wa_id, user_session)
+    return "PIN verified!\nPlease enter visitor name:"
+
+
+def handle_ask_resident_name(user_session, message_body, wa_id):
+    user_session["resident_info"]["resident_name"] = message_body
+    user_session["step"] = "ask_house_number"
+    update_session(wa_id, user_session)
+    return "Please enter your house number:"
+
+
+def handle_ask_house_number(user_session, message_body, wa_id):
+    user_session["resident_info"]["house_number"] = message_body
+    user_session["step"] = "ask_street_name"
+    update_session(wa_id, user_session)
+    return "Please enter your street name:"
+
+
+def handle_ask_street_name(user_session, message_body, wa_id):
+    user_session["resident_info"]["street_name"] = message_body
+    resident_data = {
+        "resident_name": user_session["resident_info"]["resident_name"],
+        "house_number": user_session["resident_info"]["house_number"],
+        "street_name": message_body,
+        "wa_id": wa_id,
+        "pin": user_session["resident_info"]["pin"],  # hashed at confirm_pin
+        "created_at": datetime.now(timezone.utc)
+    }
+    update_resident(wa_id, resident_data)
+    user_session["step"] = "ask_visitor_name"
+    update_session(wa_id, user_session)
+    return "Resident information saved!\nNow, please enter visitor name:"
+
+
+def handle_ask_visitor_name(user_session, message_body, wa_id):
+    user_session["visitor_info"] = {"name": message_body}
+    user_session["step"] = "ask_date"
+    update_session(wa_id, user_session)
+    return "Select visit date:\n" + DATE_MENU
+
+
+def handle_ask_date(user_session, message_body, wa_id):
+    # Visit dates are checked against the UTC date in check_code
+    today = datetime.now(timezone.utc).date()
+    offset = DATE_ALIASES.get(message_body.lower())
+
+    if offset is not None:
+        selected_date = (today + timedelta(days=offset)).isoformat()
+    elif message_body.startswith("3") or ISO_DATE_RE.match(message_body):
+        try:
+            date_str = message_body[1:].strip() if message_body.startswith("3") else message_body
+            input_date = date.fromisoformat(date_str)
+            if input_date < today:
+                return "Date cannot be in past. Enter valid date (YYYY-MM-DD)."
+            selected_date = input_date.isoformat()
+        except ValueError:
+            return "Invalid date format. Use YYYY-MM-DD."
+    else:
+        return "Invalid input. Select date:\n" + DATE_MENU
+
+    user_session["visitor_info"]["date"] = selected_date
+    user_session["step"] = "verify_pin"
+    update_session(wa_id, user_session)
+    return "Enter your 4-digit PIN to confirm booking:"
+
+
+def handle_verify_pin(user_session, message_body, wa_id):
+    now = datetime.now(timezone.utc)
+    locked_until = user_session.get("pin_locked_until")
+    if locked_until and locked_until > now:
+        return f"🔒 Too many incorrect PINs. Try again after {format_minute(locked_until)} UTC."
+
+    # Stored PIN is always a BCrypt hash (from the DB or hashed during setup)
+    stored_pin = user_session.get("resident_info", {}).get("pin")
+    if not (
+        stored_pin
+        and stored_pin.startswith("$2b$")
+        and bcrypt.checkpw(message_body.encode('utf-8'), stored_pin.encode('utf-8'))
+    ):
+        attempts = user_session.get("pin_attempts", 0) + 1
+        if attempts >= PIN_MAX_ATTEMPTS:
+            update_session(wa_id, {"pin_attempts": 0, "pin_locked_until": now + PIN_LOCKOUT})
+            return f"🔒 Too many incorrect PINs. Try again after {format_minute(now + PIN_LOCKOUT)} UTC."
+        update_session(wa_id, {"pin_attempts": attempts})
+        return "❌ Incorrect PIN. Try again or contact the facility manager for a reset."
+
+    # PIN verification successful
+    visitor_info = user_session["visitor_info"]
+    selected_date = date.fromisoformat(visitor_info["date"])
+    expiry_time = datetime.combine(
+        selected_date + timedelta(days=1),
+        datetime.min.time(),
+        tzinfo=timezone.utc
+    )
+
+    code_data = {
+        "wa_id": wa_id,
+        "name": visitor_info["name"],
+        "date": visitor_info["date"],
+        "expiry": expiry_time,
+        "used": False,
+        "verified_at": None,
+        "created_at": now,
+        "resident_name": user_session["resident_info"].get("resident_name", "Unknown"),
+        "house_number": user_session["resident_info"].get("house_number", ""),
+        "street_name": user_session["resident_info"].get("street_name", "")
+    }
+
+    expires = format_minute(expiry_time)
+
+    new_session = {
+        "step": "expect_greeting",
+        "visitor_info": {},
+        "is_returning_user": True,
+        "pin_attempts": firestore.DELETE_FIELD,
+        "pin_locked_until": firestore.DELETE_FIELD
+    }
 
-    # Get or initialize session
-    user_session = get_session(wa_id)
+    for _ in range(CODE_ATTEMPTS):
+        random_code = generate_random_code()
+        booking_data = {
+            "wa_id": wa_id,
+            "visitor_name": visitor_info["name"],
+            "date": visitor_info["date"],
+            "code": random_code,
+            "expiry": expiry_time,
+            "created_at": now
+        }
+
+        # Code, booking and session reset land together in one commit.
+        # create() fails the whole batch if the code is already taken.
+        batch = db.batch()
+        batch.create(db.collection(CODES_COLLECTION).document(random_code), code_data)
+        batch.set(db.collection("bookings").document(), booking_data)
+        batch.set(db.collection(SESSIONS_COLLECTION).document(wa_id), new_session, merge=True)
+        try:
+            batch.commit()
+            cache_session_update(wa_id, new_session)
+            break
+        except AlreadyExists:
+            logging.warning("Generated code %s already exists, retrying", random_code)
+    else:
+        return "⚠️ Could not generate a booking code. Please enter your PIN again."
+
+    return (
+        f"✅ Booking confirmed!\n"
+        f"Name: {visitor_info['name']}\n"
+        f"Date: {visitor_info['date']}\n"
+        f"Code: {random_code}\n"
+        f"Expires: {expires}\n\n"
+        f"Here's your booking details. Forward to your guest to grant access. This code expires at midnight."
+    )
+
+
+def handle_unknown_step(user_session, message_body, wa_id):
+    # Fallback for unexpected states
+    new_session = {
+        "step": "ask_visitor_name",
+        "visitor_info": {},
+        "is_returning_user": True
+    }
+    update_session(wa_id, new_session)
+    return "Let's start over. Please enter visitor name:"
+
+
+STEP_HANDLERS = {
+    "expect_greeting": handle_expect_greeting,
+    "set_pin": handle_set_pin,
+    "confirm_pin": handle_confirm_pin,
+    "ask_resident_name": handle_ask_resident_name,
+    "ask_house_number": handle_ask_house_number,
+    "ask_street_name": handle_ask_street_name,
+    "ask_visitor_name": handle_ask_visitor_name,
+    "ask_date": handle_ask_date,
+    "verify_pin": handle_verify_pin,
+}
+
+
+def generate_response(message_body, wa_id=None, name=None):
+    # Get or initialize session. Later turns are served from session_cache; on
+    # a cache miss the session and resident documents share one round trip.
+    user_session = get_cached_session(wa_id)
+    resident = None
+    if not user_session:
+        user_session, resident = get_session_and_resident(wa_id)
     if not user_session:
-        resident = get_resident(wa_id)
         if resident:
             # Returning user - start fresh with visitor name
             user_session = {
@@ -259,196 +577,12 @@ def generate_response(message_body, wa_id=None, name=None):
             update_session(wa_id, user_session)
             return "Welcome to Groot Estate Management!\nPlease set a 4-digit PIN for your bookings:"
 
-    message_body = message_body.strip()
-    step = user_session["step"]
-
-    if step == "expect_greeting":
-        if message_body.lower() in ["hi", "hello", "hey", "hola"]:
-            user_session["step"] = "ask_visitor_name"
-            update_session(wa_id, user_session)
-            return "Great! Please enter visitor name:"
-        else:
-            return "Please say hello to continue with your booking."
-    
-    if step == "set_pin":
-        if validate_pin(message_body):
-            user_session["pin"] = message_body
-            user_session["step"] = "confirm_pin"
-            update_session(wa_id, user_session)
-            return "Please confirm your 4-digit PIN:"
-        return "Invalid PIN. Please enter a more secure PIN exactly 4 digits."
-
-    elif step == "confirm_pin":
-        if message_body == user_session.get("pin"):
-            if user_session.get("is_new_user"):
-                user_session["step"] = "ask_resident_name"
-                user_session["resident_info"] = {"pin": hash_pin(user_session["pin"])}  # Hash the PIN before storing
-                update_session(wa_id, user_session)
-                return "PIN set successfully!\nPlease enter your name (resident):"
-            else:
-                # For returning users, use resident info from database
-                resident = get_resident(wa_id)
-                if resident:
-                    user_session["resident_info"] = {
-                        "resident_name": resident.get("resident_name"),
-                        "house_number": resident.get("house_number"),
-                        "street_name": resident.get("street_name"),
-                        "pin": resident.get("pin")  # Already hashed in DB
-                    }
-                user_session["step"] = "ask_visitor_name"
-                update_session(wa_id, user_session)
-                return "PIN verified!\nPlease enter visitor name:"
-        return "PINs don't match. Please enter a new 4-digit PIN:"
-
-    elif step == "ask_resident_name":
-        user_session["resident_info"] = {"resident_name": message_body}
-        user_session["step"] = "ask_house_number"
-        update_session(wa_id, user_session)
-        return "Please enter your house number:"
-
-    elif step == "ask_house_number":
-        user_session["resident_info"]["house_number"] = message_body
-        user_session["step"] = "ask_street_name"
-        update_session(wa_id, user_session)
-        return "Please enter your street name:"
-
-    elif step == "ask_street_name":
-        user_session["resident_info"]["street_name"] = message_body
-        resident_data = {
-            "resident_name": user_session["resident_info"]["resident_name"],
-            "house_number": user_session["resident_info"]["house_number"],
-            "street_name": message_body,
-            "wa_id": wa_id,
-            "pin": hash_pin(user_session["resident_info"]["pin"]),
-            "created_at": datetime.now()
-        }
-        update_resident(wa_id, resident_data)
-        user_session["step"] = "ask_visitor_name"
-        update_session(wa_id, user_session)
-        return "Resident information saved!\nNow, please enter visitor name:"
-
-    elif step == "ask_visitor_name":
-        user_session["visitor_info"] = {"name": message_body}
-        user_session["step"] = "ask_date"
-        update_session(wa_id, user_session)
-        return (
-            "Select visit date:\n"
-            "1. Today\n"
-            "2. Tomorrow\n"
-            "3. Specify date (YYYY-MM-DD)"
-        )
-
-    elif step == "ask_date":
-        today = datetime.now().date()
-        tomorrow = today + timedelta(days=1)
-
-        if message_body == "1" or message_body.lower() == "today":
-            selected_date = today.strftime("%Y-%m-%d")
-        elif message_body == "2" or message_body.lower() == "tomorrow":
-            selected_date = tomorrow.strftime("%Y-%m-%d")
-        elif message_body.startswith("3") or re.match(r"^\d{4}-\d{2}-\d{2}$", message_body):
-            try:
-                date_str = message_body.split("3")[-1].strip() if message_body.startswith("3") else message_body
-                input_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-                if input_date < today:
-                    return "Date cannot be in past. Enter valid date (YYYY-MM-DD)."
-                selected_date = input_date.strftime("%Y-%m-%d")
-            except ValueError:
-                return "Invalid date format. Use YYYY-MM-DD."
-        else:
-            return (
-                "Invalid input. Select date:\n"
-                "1. Today\n"
-                "2. Tomorrow\n"
-                "3. Specify date (YYYY-MM-DD)"
-            )
-
-        user_session["visitor_info"]["date"] = selected_date
-        user_session["step"] = "verify_pin"
-        update_session(wa_id, user_session)
-        return "Enter your 4-digit PIN to confirm booking:"
-
-    elif step == "verify_pin":
-        # Get the stored PIN (already hashed if from DB or hashed during setup)
-        stored_pin = user_session.get("resident_info", {}).get("pin")
-        
-        # Check if the stored pin is already hashed (from DB)
-        if stored_pin and stored_pin.startswith("$2b$"):  # BCrypt hash pattern
-            # Compare hashed PIN
-            if bcrypt.checkpw(message_body.encode('utf-8'), stored_pin.encode('utf-8')):
-                # PIN verification successful
-                visitor_info = user_session["visitor_info"]
-                random_code = generate_random_code()
-                selected_date = datetime.strptime(visitor_info["date"], "%Y-%m-%d").date()
-                expiry_time = datetime.combine(
-                    selected_date + timedelta(days=1),
-                    datetime.min.time()
-                )
-                
-                code_data = {
-                    "wa_id": wa_id,
-                    "name": visitor_info["name"],
-                    "date": visitor_info["date"],
-                    "expiry": expiry_time,
-                    "used": False,
-                    "verified_at": None,
-                    "created_at": datetime.now(),
-                    "resident_name": user_session["resident_info"].get("resident_name", "Unknown"),
-                    "house_number": user_session["resident_info"].get("house_number", ""),
-                    "street_name": user_session["resident_info"].get("street_name", "")
-                }
-                update_code(random_code, code_data)
-                
-                qr_data = f"Groot Estate Pass\nName: {visitor_info['name']}\nDate: {visitor_info['date']}\nCode: {random_code}\nExpires: {expiry_time.strftime('%Y-%m-%d %H:%M')}"
-                qr_image_b64, _ = generate_qr_code_base64(qr_data, visitor_info['name'])
-
-                booking_data = {
-                    "wa_id": wa_id,
-                    "visitor_name": visitor_info["name"],
-                    "date": visitor_info["date"],
-                    "code": random_code,
-                    "expiry": expiry_time,
-                    "created_at": datetime.now(),
-                    "qr_base64": qr_image_b64
-                }
-                db.collection("bookings").add(booking_data)
-                
-                new_session = {
-                    "step": "expect_greeting",
-                    "visitor_info": {},
-                    "is_returning_user": True
-                }
-                update_session(wa_id, new_session)
-                
-                return (
-                    f"✅ Booking confirmed!\n"
-                    f"Name: {visitor_info['name']}\n"
-                    f"Date: {visitor_info['date']}\n"
-                    f"Code: {random_code}\n"
-                    f"Expires: {expiry_time.strftime('%Y-%m-%d %H:%M')}\n\n"
-                    f"Here's your booking details. Forward to your guest to grant access. This code expires at midnight."
-                )
-        else:
-            # Compare plain text PIN (fallback for testing)
-            if stored_pin and message_body == stored_pin:
-                # ... [same success flow as above]
-                pass
-                
-        return "❌ Incorrect PIN. Try again or contact the facility manager for a reset."
-
-    else:
-        # Fallback for unexpected states
-        new_session = {
-            "step": "ask_visitor_name",
-            "visitor_info": {},
-            "is_returning_user": True
-        }
-        update_session(wa_id, new_session)
-        return "Let's start over. Please enter visitor name:"
+    handler = STEP_HANDLERS.get(user_session["step"], handle_unknown_step)
+    return handler(user_session, message_body.strip(), wa_id)
 
 
 def get_recent_bookings(wa_id):
-    two_months_ago = datetime.now() - timedelta(days=60)
+    two_months_ago = datetime.now(timezone.utc) - timedelta(days=60)
     bookings_ref = db.collection("bookings") \
         .where("wa_id", "==", wa_id) \
         .where("created_at", ">=", two_months_ago)
@@ -456,43 +590,22 @@ def get_recent_bookings(wa_id):
     return [doc.to_dict() for doc in bookings_ref.stream()]
 
 
-def generate_qr_code_base64(data, visitor_name):
-    save_dir = 'qr_codes'
-    os.makedirs(save_dir, exist_ok=True)
-
-    qr = qrcode.QRCode(version=1, box_size=10, border=4)
-    qr.add_data(data)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-
-    filename = f"{visitor_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-    file_path = os.path.join(save_dir, filename)
-    img.save(file_path)
-    logging.info(f"QR Code saved locally at: {file_path}")
-
-    buffered = BytesIO()
-    img.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-
-    return img_str, file_path
-
-
 def send_message(data):
-    headers = {
-        "Content-type": "application/json",
-        "Authorization": f"Bearer {current_app.config['ACCESS_TOKEN']}",
-    }
-
-    url = f"https://graph.facebook.com/{current_app.config['VERSION']}/{current_app.config['PHONE_NUMBER_ID']}/messages"
+    url, headers = get_graph_api_context()
 
     try:
-        response = requests.post(url, data=data, headers=headers, timeout=10)
+        response = http_session.post(url, data=data, headers=headers, timeout=GRAPH_API_TIMEOUT)
         response.raise_for_status()
-    except requests.Timeout:
-        logging.error("Timeout occurred while sending message")
+    except requests.Timeout as e:
+        # Not retried on read timeouts: Meta may already have accepted the message
+        logging.error(f"Timeout occurred while sending message: {e}")
         return jsonify({"status": "error", "message": "Request timed out"}), 408
     except requests.RequestException as e:
+        # HTTPError from raise_for_status carries the response; connection
+        # errors (after the connect retries) do not
         logging.error(f"Request failed: {e}")
+        if e.response is not None:
+            log_http_response(e.response)
         return jsonify({"status": "error", "message": "Failed to send message"}), 500
     else:
         log_http_response(response)
@@ -500,28 +613,28 @@ def send_message(data):
 
 
 def process_text_for_whatsapp(text):
-    text = re.sub(r"\【.*?\】", "", text).strip()
-    return re.sub(r"\*\*(.*?)\*\*", r"*\1*", text)
+    text = BRACKETS_RE.sub("", text).strip()
+    return BOLD_RE.sub(r"*\1*", text)
 
 
-def process_whatsapp_message(body):
+def process_whatsapp_message(contact, message):
     try:
-        wa_id = body["entry"][0]["changes"][0]["value"]["contacts"][0]["wa_id"]
-        name = body["entry"][0]["changes"][0]["value"]["contacts"][0]["profile"]["name"]
-        message = body["entry"][0]["changes"][0]["value"]["messages"][0]
+        wa_id = contact["wa_id"]
+        name = contact["profile"]["name"]
         
         # Check if message contains text
         if "text" in message:
             message_body = message["text"]["body"]
             
             # Check if message is from admin
-            if wa_id == app.config["ADMIN_NUMBER"]:
+            if wa_id == current_app.config["ADMIN_NUMBER"]:
                 # Admin verification logic
-                if not message_body.strip().upper().startswith("VERIFY"):
+                command = message_body.strip()
+                if command[:6].upper() != "VERIFY":
                     response = "🔍 Admin: Please send 'VERIFY <code>' to check a visitor pass"
                 else:
                     try:
-                        code = message_body.strip().upper().split()[1]
+                        code = command.split()[1]
                         verification = verify_code_admin(code)
                         response = verification["message"]
                     except IndexError:
@@ -545,78 +658,108 @@ def process_whatsapp_message(body):
             data = get_text_message_input(wa_id, error_msg)
             send_message(data)
 
+def check_code(code, verified_by):
+    """
+    Validate a visitor code and mark it as used if it grants access.
+
+    Shared by the admin WhatsApp command and the /verify_code endpoint.
+    Returns a (status, data) tuple where status is one of "invalid",
+    "corrupted", "used", "expired", "bad_date", "wrong_date" or "ok".
+    data is the code record, with "expiry" normalized to a datetime.
+    """
+    doc_ref = db.collection(CODES_COLLECTION).document(code)
+    doc = doc_ref.get()
+
+    if not doc.exists:
+        return "invalid", None
+
+    data = doc.to_dict()
+
+    # Ensure required fields exist
+    required_fields = ["used", "expiry", "wa_id", "name"]
+    if not all(field in data for field in required_fields):
+        return "corrupted", data
+
+    # Check if code was already used
+    if data["used"]:
+        return "used", data
+
+    # Convert expiry to datetime
+    expiry = data["expiry"]
+    if hasattr(expiry, "to_pydatetime"):  # Firestore Timestamp
+        expiry = expiry.to_pydatetime()
+    elif not isinstance(expiry, datetime):
+        logging.error(f"Unexpected expiry type: {type(expiry)}")
+        return "corrupted", data
+    data["expiry"] = expiry
+
+    now = datetime.now(timezone.utc)
+
+    # Check expiry
+    if expiry < now:
+        return "expired", data
+
+    # Check if today is the visit date
+    try:
+        visit_date = date.fromisoformat(data["date"])
+    except (KeyError, ValueError):
+        return "bad_date", data
+
+    if now.date() != visit_date:
+        return "wrong_date", data
+
+    # Mark code as used
+    doc_ref.update({
+        "used": True,
+        "verified_at": now,
+        "verified_by": verified_by
+    })
+    data["verified_at"] = now
+
+    return "ok", data
+
+
+# Admin reply for a valid code; optional resident fields fall back to the defaults
+ACCESS_GRANTED_TEMPLATE = (
+    "✅ Access granted\n"
+    "Resident: {resident_name}\n"
+    "Address: {address}\n"
+    "Visitor: {name}\n"
+    "Date: {date}\n"
+    "Code: {code}\n"
+    "Expires: {expires}"
+)
+ACCESS_GRANTED_DEFAULTS = {"resident_name": "Unknown", "house_number": "", "street_name": ""}
+
+
 def verify_code_admin(code):
     try:
         # Ensure code is string
         code = str(code).strip().upper()
 
-        # Use the consistent collection name
-        doc_ref = db.collection(CODES_COLLECTION).document(code)
-        doc = doc_ref.get()
+        status, data = check_code(code, verified_by="admin")
 
-        if not doc.exists:
+        if status == "invalid":
             return {"valid": False, "message": "❌ Invalid code"}
-
-        data = doc.to_dict()
-
-        # Ensure required fields exist
-        required_fields = ["used", "expiry", "wa_id", "name"]
-        if not all(field in data for field in required_fields):
+        if status == "corrupted":
             return {"valid": False, "message": "⚠️ Corrupted code record"}
-
-        # Check if code was already used
-        if data["used"]:
+        if status == "used":
             return {"valid": False, "message": "⌛ Code already used"}
-
-        # Convert expiry to datetime
-        expiry = data["expiry"]
-        if hasattr(expiry, "to_pydatetime"):  # Firestore Timestamp
-            expiry = expiry.to_pydatetime()
-        elif not isinstance(expiry, datetime):
-            logging.error(f"Unexpected expiry type: {type(expiry)}")
-            return {"valid": False, "message": "⚠️ Corrupted expiry data"}
-
-        now = datetime.now(timezone.utc)
-
-        # Check expiry
-        if expiry < now:
+        if status == "expired":
             return {"valid": False, "message": "⌛ Code expired"}
-
-        # Check if today is the visit date
-        today = now.date()
-        try:
-            visit_date = datetime.strptime(data["date"], "%Y-%m-%d").date()
-        except ValueError:
+        if status == "bad_date":
             return {"valid": False, "message": "⚠️ Invalid visit date format"}
+        if status == "wrong_date":
+            return {"valid": False, "message": f"❌ Code is only valid on {data['date']}"}
 
-        if today != visit_date:
-            return {
-                "valid": False,
-                "message": f"❌ Code is only valid on {visit_date.strftime('%Y-%m-%d')}"
-            }
-
-        # Mark code as used
-        doc_ref.update({
-            "used": True,
-            "verified_at": datetime.now(),
-            "verified_by": "admin"
+        fields = {**ACCESS_GRANTED_DEFAULTS, **data}
+        message = ACCESS_GRANTED_TEMPLATE.format_map({
+            **fields,
+            "address": f"{fields['house_number']} {fields['street_name']}".strip(),
+            "code": code,
+            "expires": format_minute(data["expiry"])
         })
 
-        resident = data.get("resident_name", "Unknown")
-        house = data.get("house_number", "")
-        street = data.get("street_name", "")
-        address = f"{house} {street}".strip()
-
-        message = (
-            "✅ Access granted\n"
-            f"Resident: {resident}\n"
-            f"Address: {address}\n"
-            f"Visitor: {data['name']}\n"
-            f"Date: {data['date']}\n"
-            f"Code: {code}\n"
-            f"Expires: {expiry.strftime('%Y-%m-%d %H:%M')}"
-        )
-
         return {"valid": True, "message": message}
 
     except Exception as e:
@@ -625,16 +768,37 @@ def verify_code_admin(code):
         return {"valid": False, "message": "⚠️ Server error - please try again"}
 
 
-def is_valid_whatsapp_message(body):
-    return (
-            body.get("object")
-            and body.get("entry")
-            and body["entry"][0].get("changes")
-            and body["entry"][0]["changes"][0].get("value")
-            and body["entry"][0]["changes"][0]["value"].get("messages")
-            and body["entry"][0]["changes"][0]["value"]["messages"][0]
-    )
+# Recently seen message ids, so webhook redeliveries from Meta are dropped
+RECENT_MESSAGE_LIMIT = 1024
+recent_message_ids = OrderedDict()
+recent_message_ids_lock = threading.Lock()
+
+
+def is_duplicate_message(message):
+    """Remember the message id and report whether it was already seen"""
+    message_id = message.get("id")
+    if not message_id:
+        return False
+
+    with recent_message_ids_lock:
+        if message_id in recent_message_ids:
+            return True
+        recent_message_ids[message_id] = None
+        if len(recent_message_ids) > RECENT_MESSAGE_LIMIT:
+            recent_message_ids.popitem(last=False)
+    return False
 
 
-if __name__ == "__main__":
-    app.run(debug=True)
+def extract_whatsapp_message(body):
+    """
+    Return (contact, message) for the first message in a webhook payload,
+    or None if the payload is not a WhatsApp message event.
+    """
+    if not body.get("object"):
+        return None
+    try:
+        value = body["entry"][0]["changes"][0]["value"]
+        contact, message = value["contacts"][0], value["messages"][0]
+    except (KeyError, IndexError, TypeError):
+        return None
+    return (contact, message) if message else None
@@ -1,24 +1,54 @@
 import logging
-import json
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, render_template
 
-from .decorators.security import signature_required
+from .decorators.security import signature_required, verify_token_required
 from .utils.whatsapp_utils import (
     process_whatsapp_message,
-    is_valid_whatsapp_message,
+    extract_whatsapp_message,
+    is_duplicate_message,
+    check_code,
+    queue_admin_notification,
+    format_timestamp,
+    format_minute,
 )
 
 webhook_blueprint = Blueprint("webhook", __name__)
 
+# Outbound work (Firestore + Graph API) runs here so webhooks return immediately.
+# Each lane is single-threaded and a sender always maps to the same lane, so
+# one wa_id's messages are handled in arrival order (the conversation steps
+# read-modify-write the session) while different senders run in parallel.
+BACKGROUND_LANES = 32
+lanes = [ThreadPoolExecutor(max_workers=1) for _ in range(BACKGROUND_LANES)]
+
+
+def run_in_background(key, func, *args):
+    """
+    Submit func(*args) to the lane for key, running it inside the current app context.
+    """
+    app = current_app._get_current_object()
+
+    def task():
+        with app.app_context():
+            try:
+                func(*args)
+            except Exception:
+                logging.exception(f"Background task {func.__name__} failed")
+
+    return lanes[hash(key) % BACKGROUND_LANES].submit(task)
+
 
 def handle_message():
     """
     Handle incoming webhook events from the WhatsApp API.
 
     This function processes incoming WhatsApp messages and other events,
-    such as delivery statuses. If the event is a valid message, it gets
-    processed. If the incoming payload is not a recognized WhatsApp event,
+    such as delivery statuses. If the event is a valid message, it is
+    queued for processing on a background thread so Meta gets its 200
+    right away. If the incoming payload is not a recognized WhatsApp event,
     an error is returned.
 
     Every message send will trigger 4 HTTP requests to your webhook: message, sent, delivered, read.
@@ -26,7 +56,20 @@ def handle_message():
     Returns:
         response: A tuple containing a JSON response and an HTTP status code.
     """
-    body = request.get_json()
+    raw = request.get_data()
+
+    # Every WhatsApp event carries an "entry" list; skip parsing anything else
+    if b'"entry"' not in raw:
+        return (
+            jsonify({"status": "error", "message": "Not a WhatsApp API event"}),
+            404,
+        )
+
+    try:
+        body = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        logging.error("Failed to decode JSON")
+        return jsonify({"status": "error", "message": "Invalid JSON provided"}), 400
     # logging.info(f"request body: {body}")
 
     # Check if it's a WhatsApp status update
@@ -39,19 +82,20 @@ def handle_message():
         logging.info("Received a WhatsApp status update.")
         return jsonify({"status": "ok"}), 200
 
-    try:
-        if is_valid_whatsapp_message(body):
-            process_whatsapp_message(body)
-            return jsonify({"status": "ok"}), 200
+    parsed = extract_whatsapp_message(body)
+    if parsed:
+        contact, message = parsed
+        if is_duplicate_message(message):
+            logging.info("Ignoring redelivered WhatsApp message.")
         else:
-            # if the request is not a WhatsApp API event, return an error
-            return (
-                jsonify({"status": "error", "message": "Not a WhatsApp API event"}),
-                404,
-            )
-    except json.JSONDecodeError:
-        logging.error("Failed to decode JSON")
-        return jsonify({"status": "error", "message": "Invalid JSON provided"}), 400
+            run_in_background(contact.get("wa_id"), process_whatsapp_message, contact, message)
+        return jsonify({"status": "ok"}), 200
+    else:
+        # if the request is not a WhatsApp API event, return an error
+        return (
+            jsonify({"status": "error", "message": "Not a WhatsApp API event"}),
+            404,
+        )
 
 
 # Required webhook verification for WhatsApp
@@ -87,3 +131,60 @@ def webhook_post():
     return handle_message()
 
 
+@webhook_blueprint.route("/verify", methods=["GET"])
+def verify_qr():
+    return render_template("verify.html")
+
+
+@webhook_blueprint.route("/verify_code", methods=["POST"])
+@verify_token_required
+def verify_code():
+    """Endpoint for security to verify codes"""
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        return jsonify({"valid": False, "message": "Invalid JSON provided"}), 400
+    code = data.get("code", "").strip().upper()
+    
+    if not code:
+        return jsonify({"valid": False, "message": "No code provided"}), 400
+    
+    status, code_data = check_code(code, verified_by="security")
+
+    if status == "invalid":
+        queue_admin_notification(f"❌ Invalid code attempt: {code}")
+        return jsonify({"valid": False, "message": "Invalid code"}), 404
+    
+    if status == "used":
+        queue_admin_notification(f"⚠️ Already used code: {code}\nVisitor: {code_data['name']}\nDate: {code_data['date']}")
+        return jsonify({"valid": False, "message": "Code already used"}), 403
+    
+    if status == "expired":
+        queue_admin_notification(f"⌛ Expired code: {code}\nVisitor: {code_data['name']}\nDate: {code_data['date']}")
+        return jsonify({"valid": False, "message": "Code expired"}), 403
+
+    if status == "wrong_date":
+        return jsonify({"valid": False, "message": f"Code is only valid on {code_data['date']}"}), 403
+
+    if status != "ok":
+        return jsonify({"valid": False, "message": "Corrupted code record"}), 500
+    
+    # Notify admin of successful verification
+    queue_admin_notification(
+        f"✅ Access granted\n"
+        f"Code: {code}\n"
+        f"Visitor: {code_data['name']}\n"
+        f"Date: {code_data['date']}\n"
+        f"Verified at: {format_timestamp(code_data['verified_at'])}"
+    )
+    
+    return jsonify({
+        "valid": True,
+        "message": "Access granted",
+        "visitor": {
+            "name": code_data["name"],
+            "date": code_data["date"],
+            "code": code,
+            "expiry": format_minute(code_data["expiry"])
+        }
+    })
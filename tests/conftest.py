@@ -0,0 +1,8 @@
+import os
+from unittest import mock
+
+# whatsapp_utils connects to Firestore at import time; tests never reach it
+os.environ.setdefault("FIREBASE_CREDENTIALS", "{}")
+mock.patch("firebase_admin.credentials.Certificate").start()
+mock.patch("firebase_admin.initialize_app").start()
+mock.patch("firebase_admin.firestore.client").start()
@@ -0,0 +1,46 @@
+from datetime import datetime, timezone
+
+from flask import Flask, jsonify, request
+
+from app.config import OrjsonProvider
+
+
+def make_app(debug=False):
+    app = Flask(__name__)
+    app.json = OrjsonProvider(app)
+    app.debug = debug
+    return app
+
+
+def test_jsonify_sorts_keys_compactly():
+    with make_app().app_context():
+        assert jsonify({"b": 1, "a": [1, 2]}).get_data() == b'{"a":[1,2],"b":1}\n'
+
+
+def test_jsonify_indents_in_debug():
+    with make_app(debug=True).app_context():
+        assert jsonify({"a": 1}).get_data() == b'{\n  "a": 1\n}\n'
+
+
+def test_datetimes_keep_flask_http_date_format():
+    app = make_app()
+    moment = datetime(2026, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+
+    assert app.json.dumps({"at": moment}) == '{"at":"Fri, 02 Jan 2026 03:04:05 GMT"}'
+
+
+def test_sort_keys_can_be_disabled():
+    app = make_app()
+
+    assert app.json.dumps({"b": 1, "a": 2}, sort_keys=False) == '{"b":1,"a":2}'
+
+
+def test_request_json_is_parsed_with_orjson():
+    app = make_app()
+
+    @app.post("/echo")
+    def echo():
+        return jsonify(request.get_json())
+
+    response = app.test_client().post("/echo", data=b'{"code": "ABC123"}', content_type="application/json")
+    assert response.get_json() == {"code": "ABC123"}
@@ -0,0 +1,55 @@
+from firebase_admin import firestore
+
+from app.utils import whatsapp_utils
+from app.utils.whatsapp_utils import cache_session_update, merge_session_fields
+
+
+def test_nested_maps_merge_field_by_field():
+    session = {"step": "ask_date", "resident_info": {"pin": "hash", "resident_name": "Ada"}}
+
+    merge_session_fields(session, {"step": "verify_pin", "resident_info": {"resident_name": "Bo"}})
+
+    assert session == {"step": "verify_pin", "resident_info": {"pin": "hash", "resident_name": "Bo"}}
+
+
+def test_delete_field_removes_the_key():
+    session = {"step": "confirm_pin", "pin": "digest"}
+
+    merge_session_fields(session, {"step": "ask_resident_name", "pin": firestore.DELETE_FIELD})
+
+    assert session == {"step": "ask_resident_name"}
+
+
+def test_empty_dict_replaces_the_map():
+    session = {"visitor_info": {"name": "Guest", "date": "2026-01-01"}}
+
+    merge_session_fields(session, {"visitor_info": {}})
+
+    assert session == {"visitor_info": {}}
+
+
+def test_dict_replaces_a_non_dict_value():
+    session = {"visitor_info": None}
+
+    merge_session_fields(session, {"visitor_info": {"name": "Guest"}})
+
+    assert session == {"visitor_info": {"name": "Guest"}}
+
+
+def test_merged_values_are_copies():
+    session = {}
+    fields = {"visitor_info": {"name": "Guest"}}
+
+    merge_session_fields(session, fields)
+    fields["visitor_info"]["name"] = "Changed"
+
+    assert session == {"visitor_info": {"name": "Guest"}}
+
+
+def test_cache_update_only_touches_cached_sessions(monkeypatch):
+    monkeypatch.setattr(whatsapp_utils, "session_cache", {"cached": {"step": "ask_date"}})
+
+    cache_session_update("cached", {"step": "verify_pin"})
+    cache_session_update("missing", {"step": "verify_pin"})
+
+    assert whatsapp_utils.session_cache == {"cached": {"step": "verify_pin"}}
@@ -0,0 +1,39 @@
+import pytest
+
+from app import create_app
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv("VERIFY_CODE_TOKEN", "gate-secret")
+    monkeypatch.setenv("PIN_HMAC_KEY", "test-key")
+    return create_app().test_client()
+
+
+def test_verify_code_rejects_a_missing_token(client):
+    response = client.post("/verify_code", json={"code": ""})
+
+    assert response.status_code == 403
+
+
+def test_verify_code_rejects_a_wrong_token(client):
+    response = client.post("/verify_code", json={"code": ""}, headers={"X-Verify-Token": "guess"})
+
+    assert response.status_code == 403
+
+
+def test_verify_code_accepts_the_shared_token(client):
+    response = client.post("/verify_code", json={"code": ""}, headers={"X-Verify-Token": "gate-secret"})
+
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "No code provided"
+
+
+def test_verify_code_is_closed_without_a_configured_token(monkeypatch):
+    monkeypatch.delenv("VERIFY_CODE_TOKEN", raising=False)
+    monkeypatch.setenv("PIN_HMAC_KEY", "test-key")
+    client = create_app().test_client()
+
+    response = client.post("/verify_code", json={"code": ""}, headers={"X-Verify-Token": ""})
+
+    assert response.status_code == 403
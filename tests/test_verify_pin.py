@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app.utils import whatsapp_utils
+from app.utils.whatsapp_utils import PIN_MAX_ATTEMPTS, handle_verify_pin, hash_pin
+
+
+@pytest.fixture
+def session_writes(monkeypatch):
+    writes = []
+    monkeypatch.setattr(whatsapp_utils, "update_session", lambda wa_id, data: writes.append(data))
+    return writes
+
+
+def make_session(**fields):
+    return {"step": "verify_pin", "resident_info": {"pin": hash_pin("1234")}, **fields}
+
+
+def test_wrong_pin_counts_the_attempt(session_writes):
+    reply = handle_verify_pin(make_session(pin_attempts=1), "0000", "123")
+
+    assert reply.startswith("❌ Incorrect PIN")
+    assert session_writes == [{"pin_attempts": 2}]
+
+
+def test_last_wrong_pin_locks_the_session(session_writes):
+    reply = handle_verify_pin(make_session(pin_attempts=PIN_MAX_ATTEMPTS - 1), "0000", "123")
+
+    assert reply.startswith("🔒")
+    assert session_writes[0]["pin_attempts"] == 0
+    assert session_writes[0]["pin_locked_until"] > datetime.now(timezone.utc)
+
+
+def test_locked_session_rejects_even_the_right_pin(session_writes):
+    locked_until = datetime.now(timezone.utc) + timedelta(minutes=5)
+
+    reply = handle_verify_pin(make_session(pin_locked_until=locked_until), "1234", "123")
+
+    assert reply.startswith("🔒")
+    assert session_writes == []